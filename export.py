@@ -5,6 +5,8 @@ Usage:
 """
 
 import argparse
+import platform
+import subprocess
 import sys
 import time
 from pathlib import Path
@@ -20,10 +22,141 @@ from models.common import Conv
 from models.yolo import Detect
 from models.experimental import attempt_load
 from utils.activations import Hardswish, SiLU
-from utils.general import colorstr, check_img_size, check_requirements, file_size, set_logging
+from utils.augmentations import letterbox
+from utils.datasets import img_formats
+from utils.general import colorstr, check_img_size, check_requirements, check_version, file_size, set_logging
 from utils.torch_utils import select_device
 
 
+def export_torchscript(model, img, file, optimize):
+    # TorchScript model export
+    prefix = colorstr('TorchScript:')
+    ts = None
+    try:
+        print(f'\n{prefix} starting export with torch {torch.__version__}...')
+        f = file.replace('.pt', '.torchscript.pt')  # filename
+        ts = torch.jit.trace(model, img, strict=False)
+        (optimize_for_mobile(ts) if optimize else ts).save(f)
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+    except Exception as e:
+        print(f'{prefix} export failure: {e}')
+    return ts  # traced model, also returned if only optimize/save failed
+
+
+def export_onnx(model, img, file, opset_version, train, dynamic, simplify):
+    # ONNX model export
+    prefix = colorstr('ONNX:')
+    try:
+        import onnx
+
+        print(f'{prefix} starting export with onnx {onnx.__version__}...')
+        f = file.replace('.pt', '.onnx')  # filename
+        torch.onnx.export(model, img, f, verbose=False, opset_version=opset_version,
+                          training=torch.onnx.TrainingMode.TRAINING if train else torch.onnx.TrainingMode.EVAL,
+                          do_constant_folding=not train,
+                          input_names=['images'],
+                          output_names=['output'],
+                          dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # shape(1,3,640,640)
+                                        'output': {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
+                                        } if dynamic else None)
+
+        # Checks
+        model_onnx = onnx.load(f)  # load onnx model
+        onnx.checker.check_model(model_onnx)  # check onnx model
+        # print(onnx.helper.printable_graph(model_onnx.graph))  # print
+
+        # Simplify
+        if simplify:
+            try:
+                check_requirements(['onnx-simplifier'])
+                import onnxsim
+
+                print(f'{prefix} simplifying with onnx-simplifier {onnxsim.__version__}...')
+                model_onnx, check = onnxsim.simplify(
+                    model_onnx,
+                    dynamic_input_shape=dynamic,
+                    input_shapes={'images': list(img.shape)} if dynamic else None)
+                assert check, 'assert check failed'
+                onnx.save(model_onnx, f)
+            except Exception as e:
+                print(f'{prefix} simplifier failure: {e}')
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+    except Exception as e:
+        print(f'{prefix} export failure: {e}')
+
+
+def export_coreml(ts, img, file, train, quantize, palettize_bits, calib_dir, precompile):
+    # CoreML model export from a traced TorchScript model
+    prefix = colorstr('CoreML:')
+    try:
+        import coremltools as ct
+
+        print(f'{prefix} starting export with coremltools {ct.__version__}...')
+        assert train, 'CoreML exports should be placed in model.train() mode with `python export.py --train`'
+        assert ts is not None, 'CoreML exports require a successful TorchScript trace'
+        assert palettize_bits == 4 or quantize == 'palettize', '--palettize-bits requires --quantize palettize'
+        if calib_dir:  # W8A8, INT8 activations only reach the INT8 compute path with INT8 weights
+            assert quantize == 'int8', '--calib-dir requires --quantize int8'
+            check_version(ct.__version__, '8.1', name='coremltools ')  # cto.linear_quantize_activations
+            assert platform.system() == 'Darwin', '--calib-dir requires macOS to run calibration predictions'
+            assert img.shape[0] == 1, '--calib-dir requires --batch-size 1'
+            files = sorted(x for x in Path(calib_dir).glob('*.*') if x.suffix[1:].lower() in img_formats)[:128]
+            assert files, f'No images found in {calib_dir}'
+            if len(files) < 32:
+                print(f'{prefix} WARNING: {len(files)} calibration images found, 32-128 recommended')
+        # iOS16 for compressed weights, iOS17 for quantized activations
+        target = ct.target.iOS17 if calib_dir else ct.target.iOS15 if quantize == 'none' else ct.target.iOS16
+        inputs = [ct.ImageType('image', shape=img.shape, scale=1 / 255.0, bias=[0, 0, 0])]
+        ct_model = ct.convert(ts, inputs=inputs, convert_to='mlprogram', compute_precision=ct.precision.FLOAT16,
+                              minimum_deployment_target=target)
+        if quantize != 'none':
+            import coremltools.optimize.coreml as cto
+
+            if calib_dir:  # activations first, then weights
+                import cv2
+                import numpy as np
+                from PIL import Image
+
+                print(f'{prefix} quantizing activations to 8-bit linear with {len(files)} calibration images '
+                      f'(unrepresentative images can collapse detection-head mAP)...')
+                sample_data = []
+                for x in files:
+                    im = letterbox(cv2.imread(str(x)), tuple(img.shape[2:]), auto=False)[0]  # BGR, same as inference
+                    sample_data.append({'image': Image.fromarray(np.ascontiguousarray(im[:, :, ::-1]))})  # to RGB
+                op_config = cto.OpLinearQuantizerConfig(mode='linear_symmetric', dtype='int8')
+                config = cto.OptimizationConfig(global_config=op_config)
+                ct_model = cto.linear_quantize_activations(ct_model, config=config, sample_data=sample_data)
+            if quantize == 'int8':
+                print(f'{prefix} quantizing weights to 8-bit linear...')
+                op_config = cto.OpLinearQuantizerConfig(mode='linear_symmetric', weight_threshold=512)
+                config = cto.OptimizationConfig(global_config=op_config)
+                ct_model = cto.linear_quantize_weights(ct_model, config=config)
+            elif quantize == 'palettize':
+                print(f'{prefix} palettizing weights to {palettize_bits}-bit k-means...')
+                op_config = cto.OpPalettizerConfig(mode='kmeans', nbits=palettize_bits, weight_threshold=2048)
+                config = cto.OptimizationConfig(global_config=op_config)
+                ct_model = cto.palettize_weights(ct_model, config=config)
+        f = file.replace('.pt', '.mlpackage')  # filename
+        ct_model.save(f)
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+
+        # Compile (bundle *.mlmodelc in app and load with MLModel(contentsOf:) to skip on-device compilation)
+        if precompile:
+            if platform.system() != 'Darwin':
+                print(f'{prefix} WARNING: --precompile requires macOS with Xcode command line tools, skipping')
+            else:
+                try:
+                    print(f'{prefix} compiling with coremlcompiler...')
+                    subprocess.run(['xcrun', 'coremlcompiler', 'compile', f, str(Path(f).parent)], check=True)
+                    fc = str(Path(f).with_suffix('.mlmodelc'))
+                    print(f'{prefix} compile success, saved as {fc} ({file_size(fc):.1f} MB)')
+                except Exception as e:
+                    print(f'{prefix} compile failure: {e}')
+    except Exception as e:
+        print(f'{prefix} export failure: {e}')
+
+
+@torch.no_grad()
 def run(weights='./yolov5s.pt',  # weights path
         img_size=(640, 640),  # image (height, width)
         batch_size=1,  # batch size
@@ -36,10 +169,15 @@ def run(weights='./yolov5s.pt',  # weights path
         dynamic=False,  # ONNX: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset_version=12,  # ONNX: opset version
+        quantize='none',  # CoreML: weight quantization, i.e. none, int8, palettize
+        palettize_bits=4,  # CoreML: k-means palettization bits, i.e. 2, 4, 6, 8 (quantize='palettize')
+        calib_dir=None,  # CoreML: calibration images dir for W8A8 INT8 quantization, requires quantize='int8'
+        precompile=False,  # CoreML: also save compiled *.mlmodelc (macOS only)
         ):
     t = time.time()
     include = [x.lower() for x in include]
-    img_size *= 2 if len(img_size) == 1 else 1  # expand
+    assert len(img_size) in (1, 2), f'--img-size takes 1 or 2 values (height, width), not {len(img_size)}'
+    img_size = [img_size[0]] * 2 if len(img_size) == 1 else list(img_size)  # expand, without mutating argument
 
     # Load PyTorch model
     device = select_device(device)
@@ -56,89 +194,31 @@ def run(weights='./yolov5s.pt',  # weights path
     if half:
         img, model = img.half(), model.half()  # to FP16
     model.train() if train else model.eval()  # training mode = no Detect() layer grid construction
-    for k, m in model.named_modules():
+    act = {nn.Hardswish: Hardswish, nn.SiLU: SiLU}  # export-friendly activations
+
+    def update(m):
         m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
-        if isinstance(m, Conv):  # assign export-friendly activations
-            if isinstance(m.act, nn.Hardswish):
-                m.act = Hardswish()
-            elif isinstance(m.act, nn.SiLU):
-                m.act = SiLU()
+        if isinstance(m, Conv) and type(m.act) in act:  # assign export-friendly activations
+            m.act = act[type(m.act)]()
         elif isinstance(m, Detect):
             m.inplace = inplace
             m.onnx_dynamic = dynamic
             # m.forward = m.forward_export  # assign forward (optional)
 
-    for _ in range(2):
-        y = model(img)  # dry runs
+    model.apply(update)
+
+    if not train:
+        y = model(img)  # dry run to build Detect() grids before tracing
     print(f"\n{colorstr('PyTorch:')} starting from {weights} ({file_size(weights):.1f} MB)")
 
-    # TorchScript export -----------------------------------------------------------------------------------------------
+    # Exports
+    ts = None
     if 'torchscript' in include or 'coreml' in include:
-        prefix = colorstr('TorchScript:')
-        try:
-            print(f'\n{prefix} starting export with torch {torch.__version__}...')
-            f = weights.replace('.pt', '.torchscript.pt')  # filename
-            ts = torch.jit.trace(model, img, strict=False)
-            (optimize_for_mobile(ts) if optimize else ts).save(f)
-            print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
-        except Exception as e:
-            print(f'{prefix} export failure: {e}')
-
-    # ONNX export ------------------------------------------------------------------------------------------------------
+        ts = export_torchscript(model, img, weights, optimize)
     if 'onnx' in include:
-        prefix = colorstr('ONNX:')
-        try:
-            import onnx
-
-            print(f'{prefix} starting export with onnx {onnx.__version__}...')
-            f = weights.replace('.pt', '.onnx')  # filename
-            torch.onnx.export(model, img, f, verbose=False, opset_version=opset_version,
-                              training=torch.onnx.TrainingMode.TRAINING if train else torch.onnx.TrainingMode.EVAL,
-                              do_constant_folding=not train,
-                              input_names=['images'],
-                              output_names=['output'],
-                              dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # shape(1,3,640,640)
-                                            'output': {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
-                                            } if dynamic else None)
-
-            # Checks
-            model_onnx = onnx.load(f)  # load onnx model
-            onnx.checker.check_model(model_onnx)  # check onnx model
-            # print(onnx.helper.printable_graph(model_onnx.graph))  # print
-
-            # Simplify
-            if simplify:
-                try:
-                    check_requirements(['onnx-simplifier'])
-                    import onnxsim
-
-                    print(f'{prefix} simplifying with onnx-simplifier {onnxsim.__version__}...')
-                    model_onnx, check = onnxsim.simplify(
-                        model_onnx,
-                        dynamic_input_shape=dynamic,
-                        input_shapes={'images': list(img.shape)} if dynamic else None)
-                    assert check, 'assert check failed'
-                    onnx.save(model_onnx, f)
-                except Exception as e:
-                    print(f'{prefix} simplifier failure: {e}')
-            print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
-        except Exception as e:
-            print(f'{prefix} export failure: {e}')
-
-    # CoreML export ----------------------------------------------------------------------------------------------------
+        export_onnx(model, img, weights, opset_version, train, dynamic, simplify)
     if 'coreml' in include:
-        prefix = colorstr('CoreML:')
-        try:
-            import coremltools as ct
-
-            print(f'{prefix} starting export with coremltools {ct.__version__}...')
-            assert train, 'CoreML exports should be placed in model.train() mode with `python export.py --train`'
-            model = ct.convert(ts, inputs=[ct.ImageType('image', shape=img.shape, scale=1 / 255.0, bias=[0, 0, 0])])
-            f = weights.replace('.pt', '.mlmodel')  # filename
-            model.save(f)
-            print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
-        except Exception as e:
-            print(f'{prefix} export failure: {e}')
+        export_coreml(ts, img, weights, train, quantize, palettize_bits, calib_dir, precompile)
 
     # Finish
     print(f'\nExport complete ({time.time() - t:.2f}s). Visualize with https://github.com/lutzroeder/netron.')
@@ -158,6 +238,14 @@ def parse_opt():
     parser.add_argument('--dynamic', action='store_true', help='ONNX: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset-version', type=int, default=12, help='ONNX: opset version')
+    parser.add_argument('--quantize', default='none', choices=['none', 'int8', 'palettize'],
+                        help='CoreML: weight quantization')
+    parser.add_argument('--palettize-bits', type=int, default=4, choices=[2, 4, 6, 8],
+                        help='CoreML: k-means palettization bits, requires --quantize palettize')
+    parser.add_argument('--calib-dir', type=str, default=None,
+                        help='CoreML: dir of 32-128 representative images for W8A8 INT8 quantization, requires '
+                             '--quantize int8, coremltools>=8.1 and macOS (unrepresentative images can collapse mAP)')
+    parser.add_argument('--precompile', action='store_true', help='CoreML: also save compiled *.mlmodelc (macOS only)')
     opt = parser.parse_args()
     return opt
 
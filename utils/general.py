@@ -99,9 +99,12 @@ def emojis(str=''):
     return str.encode().decode('ascii', 'ignore') if platform.system() == 'Windows' else str
 
 
-def file_size(file):
-    # Return file size in MB
-    return Path(file).stat().st_size / 1e6
+def file_size(path):
+    # Return file/dir size in MB
+    path = Path(path)
+    if path.is_dir():  # i.e. CoreML *.mlpackage
+        return sum(f.stat().st_size for f in path.glob('**/*') if f.is_file()) / 1e6
+    return path.stat().st_size / 1e6
 
 
 def check_online():